@@ -4,21 +4,34 @@ This app uses different AI services (Azure, Groq, or OpenAI) to generate charts
 
 Author: Tammy DiPrima (modified for multiple providers)
 """
-import datetime
+import asyncio
+import atexit
+import functools
+import hashlib
+import multiprocessing
 import os
 import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import dash
 import dash_bootstrap_components as dbc
-import pandas as pd
-import pandas_datareader as pdr
-import plotly.express as px
+import diskcache
+import httpx
+import plotly.io
+from a2wsgi import WSGIMiddleware
 from dash import html, dcc, Input, Output, State, exceptions
 from dotenv import load_dotenv
 
+import chart_worker
+
 # Load environment variables
 load_dotenv()
 
+# Serialize callback responses with orjson instead of the stdlib encoder
+plotly.io.json.config.default_engine = "orjson"
+
 # Choose AI provider (comment out the ones you don't want to use)
 AI_PROVIDER = "azure"  # Options: "azure", "groq", "openai"
 
@@ -36,51 +49,879 @@ SYSTEM_MESSAGE_CONTENT = (
     "ALWAYS give the date or dates of the data in the title."
 )
 
+# Stable few-shot block appended to the system message. Besides showing the expected
+# output shape, it lifts the prefix past the 1024-token threshold at which OpenAI/Azure
+# cache prompt prefixes server-side, so only the user message is re-processed per request.
+# Keep this text byte-for-byte stable; any edit invalidates the provider-side cache.
+SYSTEM_FEW_SHOT_EXAMPLES = """
+
+Examples of correct responses follow. Each shows a request and the exact response expected.
+
+Request: Line chart of average patient heart rate over 7 days.
+Response:
+import pandas as pd
+import plotly.express as px
+from datetime import datetime
+
+dates = pd.date_range(end=datetime.now().date(), periods=7)
+data = pd.DataFrame({
+    'Date': dates,
+    'Heart Rate': [70, 72, 68, 75, 71, 73, 69]
+})
+fig = px.line(
+    data,
+    x='Date',
+    y='Heart Rate',
+    title=f'Average Patient Heart Rate ({dates[0].date()} to {dates[-1].date()})'
+)
+fig.show()
+
+Request: Plot the daily closing prices of Apple stock over the past year.
+Response:
+import datetime
+import plotly.express as px
+import yfinance as yf
+
+end = datetime.date.today()
+start = end - datetime.timedelta(days=365)
+data = yf.download('AAPL', start=start, end=end)
+if data.empty:
+    fig = px.line(title=f'No data found ({start} to {end})')
+else:
+    fig = px.line(
+        x=data.index,
+        y=data['Close'].squeeze(),
+        labels={'x': 'Date', 'y': 'Close (USD)'},
+        title=f'Apple (AAPL) Daily Close ({start} to {end})'
+    )
+fig.show()
+
+Request: Create a bar chart of the top 5 countries by GDP.
+Response:
+import pandas as pd
+import plotly.express as px
+
+data = pd.DataFrame({
+    'Country': ['United States', 'China', 'Germany', 'Japan', 'India'],
+    'GDP (USD trillions)': [27.36, 17.79, 4.46, 4.21, 3.55]
+})
+fig = px.bar(
+    data,
+    x='Country',
+    y='GDP (USD trillions)',
+    title='Top 5 Countries by Nominal GDP (2023, World Bank)'
+)
+fig.show()
+
+Request: Show a pie chart of the world population by continent.
+Response:
+import pandas as pd
+import plotly.express as px
+
+data = pd.DataFrame({
+    'Continent': ['Asia', 'Africa', 'Europe', 'North America', 'South America', 'Oceania'],
+    'Population (millions)': [4753, 1460, 742, 604, 439, 45]
+})
+fig = px.pie(
+    data,
+    names='Continent',
+    values='Population (millions)',
+    title='World Population by Continent (2023, UN estimates)'
+)
+fig.show()
+
+Request: Scatter plot of US unemployment rate versus inflation by year from 2015 to 2023.
+Response:
+import pandas as pd
+import plotly.express as px
+
+data = pd.DataFrame({
+    'Year': [2015, 2016, 2017, 2018, 2019, 2020, 2021, 2022, 2023],
+    'Unemployment Rate (%)': [5.3, 4.9, 4.4, 3.9, 3.7, 8.1, 5.4, 3.6, 3.6],
+    'Inflation Rate (%)': [0.1, 1.3, 2.1, 2.4, 1.8, 1.2, 4.7, 8.0, 4.1]
+})
+fig = px.scatter(
+    data,
+    x='Unemployment Rate (%)',
+    y='Inflation Rate (%)',
+    text='Year',
+    title='US Unemployment vs Inflation (2015 to 2023, BLS)'
+)
+fig.show()
+
+Request: Line chart comparing monthly average temperatures in New York and London for 2023.
+Response:
+import pandas as pd
+import plotly.express as px
+
+months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+data = pd.DataFrame({
+    'Month': months * 2,
+    'City': ['New York'] * 12 + ['London'] * 12,
+    'Avg Temperature (C)': [
+        4.6, 3.4, 6.4, 11.9, 16.6, 21.7, 25.6, 24.2, 21.7, 15.8, 8.8, 6.8,
+        5.8, 6.9, 8.4, 10.3, 14.6, 19.4, 18.3, 18.8, 19.4, 14.3, 9.0, 7.4
+    ]
+})
+fig = px.line(
+    data,
+    x='Month',
+    y='Avg Temperature (C)',
+    color='City',
+    markers=True,
+    title='Monthly Average Temperature, New York vs London (Jan 2023 to Dec 2023)'
+)
+fig.show()
+
+Request: Plot the number of unicorns born on Mars last week.
+Response:
+import datetime
+import plotly.express as px
+
+end = datetime.date.today()
+start = end - datetime.timedelta(days=7)
+fig = px.bar(title=f'No data found ({start} to {end})')
+fig.show()
+"""
+
+SYSTEM_MESSAGE_CONTENT += SYSTEM_FEW_SHOT_EXAMPLES
+
 # ==============================
 # AI Service Configurations
 # ==============================
 
-# Azure OpenAI Configuration (comment out if not using)
-if AI_PROVIDER == "azure":
-    from openai import AzureOpenAI
+# One pooled HTTP/2 client shared by the provider SDKs, so concurrent requests reuse
+# warm connections instead of paying a TCP+TLS handshake each time.
+_http = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+)
+
+if AI_PROVIDER not in ("azure", "groq", "openai"):
+    raise ValueError("Invalid AI_PROVIDER. Choose 'azure', 'groq', or 'openai'.")
+
+
+@functools.lru_cache(maxsize=None)
+def _get_client(provider):
+    """Create a provider's client on first use, so its SDK is only imported when needed."""
+    # Azure OpenAI Configuration
+    if provider == "azure":
+        from openai import AsyncAzureOpenAI
+
+        return AsyncAzureOpenAI(
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_KEY"),
+            api_version=os.getenv("OPENAI_API_VERSION"),
+            http_client=_http
+        )
+
+    # Groq Configuration
+    if provider == "groq":
+        from groq import AsyncGroq
+
+        return AsyncGroq(
+            api_key=os.getenv("GROQ_API_KEY"),
+            http_client=_http
+        )
+
+    # OpenAI Configuration
+    if provider == "openai":
+        from openai import AsyncOpenAI
+
+        return AsyncOpenAI(http_client=_http)
+
+    raise ValueError("Invalid AI_PROVIDER. Choose 'azure', 'groq', or 'openai'.")
+
+
+# ==============================
+# LLM Event Loop
+# ==============================
+
+# Dash runs each async callback on its own short-lived loop, but the async clients keep
+# pooled connections bound to the loop they were first used on. All API calls therefore
+# run on this one long-lived loop, and callbacks await the result from theirs.
+_LOOP = asyncio.new_event_loop()
+threading.Thread(target=_LOOP.run_forever, name="llm-loop", daemon=True).start()
 
-    client = AzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_KEY"),
-        api_version=os.getenv("OPENAI_API_VERSION")
+
+@atexit.register
+def _close_http():
+    # The pooled connections live on the LLM loop, so close them there
+    asyncio.run_coroutine_threadsafe(_http.aclose(), _LOOP).result(timeout=5)
+
+
+def _on_loop(coro):
+    """Schedule a coroutine on the shared LLM loop and return an awaitable for its result."""
+    return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, _LOOP))
+
+
+# Generated charts are typically under 300 tokens; decode time grows with every token allowed.
+MAX_COMPLETION_TOKENS = 600
+
+# Halt generation at the final top-level fig.show(), which the server never needs since the
+# figure is returned to Dash. No fence stop: it would also fire on an opening fence after a
+# line of preamble; _CodeStream stops reading at a real closing fence instead.
+STOP_SEQUENCES = ["\nfig.show()"]
+
+
+def _completion_kwargs(selected_model=None, provider=None):
+    """Model and sampling parameters for a provider (the configured one by default)."""
+    provider = provider or AI_PROVIDER
+    if provider == "azure":
+        return {
+            "model": os.getenv("DEPLOYMENT_NAME"),
+            "max_tokens": MAX_COMPLETION_TOKENS,
+            "stop": STOP_SEQUENCES,
+            "temperature": 0.2,
+            "top_p": 0.1
+        }
+    if provider == "groq":
+        return {
+            "model": "meta-llama/llama-4-scout-17b-16e-instruct",
+            "max_tokens": MAX_COMPLETION_TOKENS,
+            "stop": STOP_SEQUENCES,
+            "temperature": 0.05,
+            "top_p": 0.05,
+            "timeout": 30
+        }
+    return {
+        "model": selected_model if selected_model else "gpt-4o",
+        "max_tokens": MAX_COMPLETION_TOKENS,
+        "stop": STOP_SEQUENCES,
+        "temperature": 0.2,
+        "top_p": 0.1
+    }
+
+
+# Dropdown models (OpenAI/Azure)
+MODEL_OPTIONS = [
+    {'label': 'GPT-3.5 Turbo', 'value': 'gpt-3.5-turbo'},
+    {'label': 'GPT-4o', 'value': 'gpt-4o'},
+    {'label': 'GPT-4o Mini', 'value': 'gpt-4o-mini'},
+    {'label': 'GPT-4.5 Preview', 'value': 'gpt-4.5-preview'},
+    {'label': 'o1 Mini', 'value': 'o1-mini'}
+]
+
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_MESSAGE_CONTENT}
+_USER_PROMPT_PREFIX = "Generate only the Plotly Express Python code for: "
+_USER_PROMPT_SUFFIX = ". No explanations or text, just the code. Terminate the code with fig.show()."
+
+# Every request starts with the same system message; keeping that prefix byte-identical
+# is what lets the provider's prompt cache match it.
+def _build_messages(user_content):
+    return [_SYSTEM_MESSAGE, {"role": "user", "content": user_content}]
+
+
+class _CodeStream:
+    """Accumulates a streamed reply, dropping any opening markdown fence and preamble.
+
+    Sets ``complete`` once the closing fence or a top-level ``fig.show()`` arrives,
+    so the caller can stop reading instead of waiting for trailing prose.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.complete = False
+        self._opened = False
+
+    def feed(self, delta):
+        self.text += delta
+
+        fence = self.text.find("```")
+        while fence != -1:
+            before = self.text[:fence]
+            if self._opened:
+                self.text = before.rstrip()
+                self.complete = True
+                return
+
+            line_end = self.text.find("\n", fence)
+            if line_end == -1:
+                return  # wait for the rest of the fence line
+            if self.text[fence + 3:line_end].strip() or not _looks_like_code(before):
+                # Opening fence (has a language tag, or only preamble precedes it)
+                self.text = self.text[line_end + 1:]
+                self._opened = True
+                fence = self.text.find("```")
+            else:
+                # A bare fence right after unfenced code closes it
+                self.text = before.rstrip()
+                self.complete = True
+                return
+
+        end = self.text.find("\nfig.show()\n")
+        if end != -1:
+            self.text = self.text[:end + len("\nfig.show()")]
+            self.complete = True
+
+
+def _looks_like_code(text):
+    """True if text, once sanitized, is non-empty and parses as Python (i.e. is not preamble)."""
+    code = _clean_code(text)
+    if not code:
+        return False
+    try:
+        compile(code, "<llm>", "exec")
+    except SyntaxError:
+        return False
+    return True
+
+
+async def _request_code(prompt, selected_model=None, provider=None, on_delta=None):
+    """Stream chart code from a provider (the configured one by default) and return it once complete.
+
+    If given, ``on_delta`` is called with the code received so far after every chunk.
+    """
+    provider = provider or AI_PROVIDER
+    kwargs = _completion_kwargs(selected_model, provider)
+    if provider in ["openai", "azure"]:
+        kwargs["stream_options"] = {"include_usage": True}
+
+    stream = await _get_client(provider).chat.completions.create(
+        messages=_build_messages(_USER_PROMPT_PREFIX + prompt + _USER_PROMPT_SUFFIX),
+        stream=True,
+        **kwargs
     )
+    code = _CodeStream()
+    try:
+        async for chunk in stream:
+            # Usage arrives on a final, choice-less chunk, which is skipped if we stop early
+            _log_usage(chunk)
+            if chunk.choices:
+                code.feed(chunk.choices[0].delta.content or "")
+                if on_delta is not None:
+                    on_delta(code.text)
+                if code.complete:
+                    break
+    finally:
+        await stream.close()
+    return code.text
+
+
+def _log_usage(response):
+    """Print token usage, including how much of the prompt was served from the provider's prefix cache."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    print(f"Prompt tokens: {usage.prompt_tokens} ({cached} cached), completion tokens: {usage.completion_tokens}")
 
-# Groq Configuration (comment out if not using)
-elif AI_PROVIDER == "groq":
-    from groq import Groq
 
-    client = Groq(
-        api_key=os.getenv("GROQ_API_KEY")
+# ==============================
+# Prompt Batching
+# ==============================
+
+# Prompts arriving within BATCH_WINDOW_MS of each other (same model, up to BATCH_MAX_PROMPTS)
+# share one API round-trip. Off by default: each prompt waits up to one window first, and
+# different users' prompts end up in one message, so one prompt can steer the code generated
+# for another. Batched answers are therefore never written to the response cache.
+BATCH_WINDOW_MS = int(os.getenv("BATCH_WINDOW_MS", "0"))
+BATCH_MAX_PROMPTS = 8
+BATCH_MAX_TOKENS = 4096
+
+_BATCH_MARKER_RE = re.compile(r"^#+\s*CHART\s+(\d+)\s*$", re.MULTILINE | re.IGNORECASE)
+_MARKER_LIKE_RE = re.compile(r"#+\s*CHART\s+\d+", re.IGNORECASE)
+
+
+def _batch_safe(prompt):
+    """Flatten a prompt onto one line without marker-like text, so it cannot open another answer."""
+    return " ".join(_MARKER_LIKE_RE.sub(" ", prompt).split())
+
+
+async def _request_batch(prompts, selected_model=None):
+    """Ask for several charts in one completion and return the reply split per prompt.
+
+    Entries are None where the model did not answer under the expected marker.
+    """
+    requests = "\n\n".join(f"### CHART {i}\n{_batch_safe(prompt)}" for i, prompt in enumerate(prompts, 1))
+    kwargs = _completion_kwargs(selected_model)
+    kwargs["max_tokens"] = min(kwargs["max_tokens"] * len(prompts), BATCH_MAX_TOKENS)
+    kwargs.pop("stop", None)  # every answer ends with fig.show(); stopping would cut off the rest
+    response = await _get_client(AI_PROVIDER).chat.completions.create(
+        messages=_build_messages(
+            f"Generate only the Plotly Express Python code for each of these {len(prompts)} requests. "
+            "Begin each answer with its marker line exactly as given (e.g. '### CHART 1') "
+            "and put nothing else on that line. No explanations or text, just the code.\n\n"
+            f"{requests}"
+        ),
+        **kwargs
     )
+    _log_usage(response)
 
-# OpenAI Configuration (comment out if not using)
-elif AI_PROVIDER == "openai":
-    from openai import OpenAI
+    parts = _BATCH_MARKER_RE.split(response.choices[0].message.content)
+    answers = {int(number): text.strip() for number, text in zip(parts[1::2], parts[2::2])}
+    return [answers.get(i) or None for i in range(1, len(prompts) + 1)]
 
-    client = OpenAI()
 
-else:
-    raise ValueError("Invalid AI_PROVIDER. Choose 'azure', 'groq', or 'openai'.")
+class _PromptBatcher:
+    """Coalesces prompts submitted on the LLM loop into shared API calls."""
+
+    def __init__(self, window, max_prompts):
+        self.window = window
+        self.max_prompts = max_prompts
+        self._queue = None
+
+    async def submit(self, prompt, selected_model=None):
+        """Queue a prompt and wait for (raw reply, shared). Must run on the LLM loop.
+
+        ``shared`` is True when the reply came from a request mixing several prompts.
+        """
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            asyncio.create_task(self._drain())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, selected_model, future))
+        return await future
+
+    async def _drain(self):
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(self.window)
+            while len(batch) < self.max_prompts and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            by_model = {}
+            for item in batch:
+                by_model.setdefault(_completion_kwargs(item[1])["model"], []).append(item)
+            for items in by_model.values():
+                asyncio.create_task(self._dispatch(items))
+
+    async def _dispatch(self, items):
+        if len(items) == 1:
+            prompt, selected_model, future = items[0]
+            await _settle(future, _request_solo(prompt, selected_model))
+            return
+
+        try:
+            answers = await _request_batch([prompt for prompt, _, _ in items], items[0][1])
+        except Exception as e:
+            for _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (prompt, selected_model, future), answer in zip(items, answers):
+            if answer is None:
+                # The model skipped or mangled this one; ask for it on its own
+                asyncio.create_task(_settle(future, _request_solo(prompt, selected_model)))
+            elif not future.done():
+                future.set_result((answer, True))
+
+
+async def _request_solo(prompt, selected_model=None):
+    return await _request_code(prompt, selected_model), False
+
+
+async def _settle(future, coro):
+    """Resolve a future with the outcome of a coroutine."""
+    try:
+        result = await coro
+    except Exception as e:
+        if not future.done():
+            future.set_exception(e)
+    else:
+        if not future.done():
+            future.set_result(result)
+
+
+_batcher = _PromptBatcher(BATCH_WINDOW_MS / 1000, BATCH_MAX_PROMPTS)
+
+
+async def _generate_code(prompt, selected_model=None, on_delta=None):
+    """Fetch (raw reply, shared) for one prompt, batched with concurrent prompts when enabled.
+
+    ``shared`` marks replies from a mixed batch. ``on_delta`` only sees partial code on the
+    streamed (unbatched) path.
+    """
+    if BATCH_WINDOW_MS > 0:
+        return await _batcher.submit(prompt, selected_model)
+    return await _request_code(prompt, selected_model, on_delta=on_delta), False
+
+
+# Console noise that sometimes gets pasted into the code
+_UNWANTED_LINES = (
+    "YF.download() has changed argument auto_adjust default to True",
+    "[*********************100%***********************]  1 of 1 completed"
+)
+
+# Lines that start with these are prose, not code
+_UNWANTED_STARTS = ('here is', 'below is', 'the code', 'this code', 'note:')
+
+# Everything the sanitizer drops, fused into one compiled alternation: prose lines
+# (possibly glued to a fence), markdown fences, and console noise
+_DROP_RE = re.compile(
+    "|".join([
+        r"^(?:```(?:python)?)?(?:" + "|".join(map(re.escape, _UNWANTED_STARTS)) + r").*$",
+        r"```(?:python)?",
+        *map(re.escape, _UNWANTED_LINES)
+    ]),
+    re.MULTILINE | re.IGNORECASE
+)
+
+
+def _clean_code(content):
+    """Strip markdown fences, console noise and prose lines from an LLM reply."""
+    code = _DROP_RE.sub("", content.strip())
+    return '\n'.join(line for line in code.split('\n') if line.strip()).strip()
+
+
+# ==============================
+# Code Execution Pool
+# ==============================
+
+# Generated code runs in warm worker processes (see chart_worker.py). Workers are spawned
+# rather than forked because this process already runs the LLM loop thread. Spawned workers
+# re-import the launch script, so start the app with run.py (or uvicorn), never this file.
+EXEC_WORKERS = 4
+
+
+def _make_exec_pool():
+    pool = ProcessPoolExecutor(
+        max_workers=EXEC_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=chart_worker.preimport
+    )
+    # Workers only start when work is submitted; start them all now so the first charts
+    # don't wait for a spawn plus the pandas/plotly imports
+    for _ in range(EXEC_WORKERS):
+        pool.submit(os.getpid)
+    return pool
+
+
+_exec_pool = _make_exec_pool()
+
+
+async def _execute_code(code):
+    """Run generated code in the pool and return the figure JSON."""
+    global _exec_pool
+
+    # Ensure there's still some code left
+    if not code:
+        raise ValueError("No valid code remaining after filtering.")
+
+    pool = _exec_pool
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, chart_worker.run_code, code)
+    except BrokenProcessPool:
+        # A crashed worker poisons the whole pool; start a fresh one for the next chart
+        # (unless a concurrent request already did) and release the old one
+        if _exec_pool is pool:
+            _exec_pool = _make_exec_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+
+# ==============================
+# Hedged Requests
+# ==============================
+
+# With HEDGED=true, every provider with credentials in the environment is asked at once and
+# the first reply that renders wins. Cuts tail latency and rides out a provider outage, but
+# multiplies token cost, so it is off by default.
+HEDGED = os.getenv("HEDGED", "").lower() in ("1", "true", "yes")
+
+_PROVIDER_ENV_VARS = {
+    "azure": ("AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_KEY", "DEPLOYMENT_NAME"),
+    "groq": ("GROQ_API_KEY",),
+    "openai": ("OPENAI_API_KEY",)
+}
+
+
+def _enabled(provider):
+    return all(os.getenv(name) for name in _PROVIDER_ENV_VARS[provider])
+
+
+_hedge_providers = [AI_PROVIDER] + [
+    provider for provider in _PROVIDER_ENV_VARS
+    if HEDGED and provider != AI_PROVIDER and _enabled(provider)
+]
+
+
+async def _hedged_generate(prompt, selected_model=None):
+    """Race all configured providers and return (code, figure JSON) from the first reply that renders.
+
+    Only the LLM calls race. Replies are executed one at a time in arrival order, because a
+    chart already running in the execution pool can't be cancelled; a slower reply is only
+    run if the faster ones failed.
+    """
+    pending = {
+        _on_loop(_request_code(prompt, selected_model, provider)): provider
+        for provider in _hedge_providers
+    }
+    error = None
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for reply in done:
+                provider = pending.pop(reply)
+                try:
+                    code = _clean_code(reply.result())
+                    fig_json = await _execute_code(code)
+                except Exception as e:
+                    error = e
+                    print(f"{provider}: {e}")
+                    continue
+                print(f"Hedged request answered by {provider}")
+                return code, fig_json
+        raise error
+    finally:
+        for reply in pending:
+            reply.cancel()
+
+
+# ==============================
+# Response Cache
+# ==============================
+
+# Exact tier: cleaned code that executed successfully, keyed by provider, model,
+# system message and prompt. Replies are near-deterministic at these temperatures.
+CACHE_TTL = 86400  # seconds
+_cache = diskcache.Cache(".chart_cache")
+
+# Semantic tier: paraphrased prompts are matched by embedding similarity.
+# Set EMBEDDING_MODEL (model name, or deployment name on Azure) to enable; OpenAI/Azure only.
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
+SEMANTIC_THRESHOLD = 0.93  # calibrated for int8-quantized embeddings (0.95 at float32)
+
+
+def _cache_key(model, prompt):
+    raw = f"{AI_PROVIDER}|{model}|{SYSTEM_MESSAGE_CONTENT}|{prompt.strip()}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class _SemanticCache:
+    """In-memory cosine-similarity index from prompt embeddings to exact-tier cache keys.
+
+    Embeddings are L2-normalized and stored as int8 with a fixed 1/127 scale, a quarter
+    of the float32 footprint. Lookups score the index in fixed-size blocks so the float32
+    temporaries stay small however large the cache grows.
+    """
+
+    _BLOCK_ROWS = 4096
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._vectors = None  # int8 rows, capacity doubled as needed
+        self._model_ids = None
+        self._size = 0
+        self._models = {}
+        self._keys = []
+
+    @staticmethod
+    def _normalize(embedding):
+        import numpy as np
+
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def add(self, embedding, model, key):
+        import numpy as np
+
+        quantized = np.round(self._normalize(embedding) * 127).astype(np.int8)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.empty((16, quantized.size), dtype=np.int8)
+                self._model_ids = np.empty(16, dtype=np.int32)
+            elif self._size == len(self._vectors):
+                self._vectors = np.concatenate([self._vectors, np.empty_like(self._vectors)])
+                self._model_ids = np.concatenate([self._model_ids, np.empty_like(self._model_ids)])
+
+            self._vectors[self._size] = quantized
+            self._model_ids[self._size] = self._models.setdefault(model, len(self._models))
+            self._keys.append(key)
+            self._size += 1
+
+    def lookup(self, embedding, model):
+        """Return the cache key of the closest prompt for this model, or None below threshold."""
+        import numpy as np
+
+        vector = self._normalize(embedding) / 127
+        with self._lock:
+            model_id = self._models.get(model)
+            if model_id is None:
+                return None
+
+            best_score, best_row = -1.0, None
+            for start in range(0, self._size, self._BLOCK_ROWS):
+                stop = min(start + self._BLOCK_ROWS, self._size)
+                scores = self._vectors[start:stop].astype(np.float32) @ vector
+                scores[self._model_ids[start:stop] != model_id] = -1.0
+                row = int(np.argmax(scores))
+                if scores[row] > best_score:
+                    best_score, best_row = float(scores[row]), start + row
+
+            return self._keys[best_row] if best_score >= self.threshold else None
+
+
+_semantic_cache = _SemanticCache(SEMANTIC_THRESHOLD)
+
+
+async def _embed(prompt):
+    response = await _get_client(AI_PROVIDER).embeddings.create(model=EMBEDDING_MODEL, input=prompt.strip())
+    return response.data[0].embedding
+
+
+async def _lookup_cache(prompt, model):
+    """Return (code, key, embedding, hit_key); code is None on a miss.
+
+    key is where a fresh reply for this prompt belongs, hit_key the entry the code came from.
+    """
+    key = _cache_key(model, prompt)
+    code = _cache.get(key)
+    if code is not None or not EMBEDDING_MODEL or AI_PROVIDER not in ["openai", "azure"]:
+        return code, key, None, key
+
+    try:
+        embedding = await _on_loop(_embed(prompt))
+    except Exception as e:
+        # A broken embedding setup should only disable the semantic tier
+        print(e)
+        return None, key, None, None
+
+    similar_key = _semantic_cache.lookup(embedding, model)
+    code = _cache.get(similar_key) if similar_key else None
+    return code, key, embedding, similar_key
+
+
+# ==============================
+# Chart Pipeline
+# ==============================
+
+async def _generate_figure(prompt, selected_model=None, on_delta=None):
+    """Turn a prompt into figure JSON: cache lookup, generation, execution, cache store."""
+    model = _completion_kwargs(selected_model)["model"]
+    code, cache_key, embedding, hit_key = await _lookup_cache(prompt, model)
+    if code is not None:
+        try:
+            # Execute the code in a worker process
+            return await _execute_code(code)
+        except Exception as e:
+            # Drop code that no longer runs (e.g. a delisted ticker), or every Retry
+            # would replay the same failure until the entry expired
+            print(e)
+            _cache.delete(hit_key)
+
+    fig_json = None
+    shared = False
+    if len(_hedge_providers) > 1:
+        # The winning provider's code has already been executed
+        code, fig_json = await _hedged_generate(prompt, selected_model)
+    else:
+        # Run the API call on the shared loop so this worker is free while the LLM generates
+        content, shared = await _on_loop(_generate_code(prompt, selected_model, on_delta))
+        code = _clean_code(content)
+
+    # print(code)  # DEBUG
+
+    if fig_json is None:
+        # Execute the code in a worker process
+        fig_json = await _execute_code(code)
+
+    # Code from a mixed batch may have been steered by another user's prompt; don't keep it
+    if not shared:
+        _cache.set(cache_key, code, expire=CACHE_TTL)
+        if embedding is not None:
+            _semantic_cache.add(embedding, model, cache_key)
+
+    return fig_json
+
+
+def _error_message(e):
+    error_msg = "Error: An issue occurred while generating the chart. "
+
+    if "API" in str(e) or any(provider in str(e).lower() for provider in ["azure", "groq", "openai"]):
+        error_msg += "Please check your API key or network connection."
+    elif "invalid syntax" in str(e) or "NameError" in str(e):
+        error_msg += "The AI generated invalid code. Please refine your prompt and try again."
+    elif "unexpected text" in str(e):
+        error_msg += "The AI included extra text instead of just code. Please try again or adjust the prompt."
+    elif "No valid code" in str(e) or "Failed to generate a valid Plotly figure" in str(e):
+        error_msg += (
+            "The chart could not be created. Check if the data or prompt is valid, "
+            "or try a different chart type."
+        )
+    else:
+        error_msg += (
+            f"Unexpected error: {str(e)}. "
+            "Please try a different prompt or contact support."
+        )
+    return error_msg
+
+
+# ==============================
+# WebSocket Streaming
+# ==============================
+
+# With USE_WEBSOCKET=true, the page talks to the server over one WebSocket instead of a
+# callback request per click, and shows the code as it streams in. Requires serving
+# asgi_app under uvicorn; the Flask dev server cannot accept WebSockets.
+USE_WEBSOCKET = os.getenv("USE_WEBSOCKET", "").lower() in ("1", "true", "yes")
+# Unset, the browser connects back to the host that served the page
+WEBSOCKET_URL = os.getenv("WEBSOCKET_URL")
+
+if USE_WEBSOCKET:
+    from dash_extensions import WebSocket
+    from starlette.applications import Starlette
+    from starlette.routing import Mount, WebSocketRoute
+    from starlette.websockets import WebSocketDisconnect
+
+
+async def _stream_chart(websocket, prompt, selected_model=None):
+    """Answer one chart request: partial code messages while generating, then the figure."""
+    if not prompt or not prompt.strip():
+        await websocket.send_json({"type": "error", "message": "Error: Please enter a prompt."})
+        return
+
+    # Deltas arrive on the LLM loop; hand them to this loop and send only the latest text
+    loop = asyncio.get_running_loop()
+    partial = asyncio.Queue()
+
+    async def send_partials():
+        while True:
+            code = await partial.get()
+            while not partial.empty():
+                code = partial.get_nowait()
+            await websocket.send_json({"type": "partial", "code": code})
+
+    sender = asyncio.create_task(send_partials())
+    try:
+        fig_json = await _generate_figure(
+            prompt,
+            selected_model,
+            on_delta=lambda code: loop.call_soon_threadsafe(partial.put_nowait, code)
+        )
+    except Exception as e:
+        print(e)
+        await websocket.send_json({"type": "error", "message": _error_message(e)})
+        return
+    finally:
+        sender.cancel()
+
+    # fig_json is already JSON; embed it as a string rather than decoding and re-encoding it
+    await websocket.send_json({"type": "fig", "figure": fig_json})
+
+
+async def _llm_websocket(websocket):
+    await websocket.accept()
+    try:
+        while True:
+            request = await websocket.receive_json()
+            await _stream_chart(websocket, request.get("prompt"), request.get("model"))
+    except WebSocketDisconnect:
+        pass
+
 
 # Dash App Setup
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
+app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], compress=True)
 
 app.layout = html.Div([
     html.H2("AI Chart Builder", style={'textAlign': 'center'}),
     dcc.Dropdown(
         id='model-dropdown',
-        options=[
-            {'label': 'GPT-3.5 Turbo', 'value': 'gpt-3.5-turbo'},
-            {'label': 'GPT-4o', 'value': 'gpt-4o'},
-            {'label': 'GPT-4o Mini', 'value': 'gpt-4o-mini'},
-            {'label': 'GPT-4.5 Preview', 'value': 'gpt-4.5-preview'},
-            {'label': 'o1 Mini', 'value': 'o1-mini'}
-        ] if AI_PROVIDER in ["openai", "azure"] else [],
+        options=MODEL_OPTIONS if AI_PROVIDER in ["openai", "azure"] else [],
         value='gpt-4o',  # Default model for OpenAI/Azure
         style={'width': '100%', 'marginBottom': 10}
     ),
@@ -90,42 +931,30 @@ app.layout = html.Div([
         style={'width': '100%', 'height': 100}
     ),
     html.Button('Generate Chart', id='submit', n_clicks=0, className='btn btn-primary'),
-    dcc.Loading(id="loading", type="circle", children=dcc.Graph(id='output-chart')),
-    html.Div(id='feedback', style={'marginTop': 10}),
+    dcc.Loading(id="loading", type="circle", children=[
+        dcc.Graph(id='output-chart'),
+        # Figure JSON from the worker, handed to the graph in the browser as-is
+        dcc.Store(id='fig-store')
+    ]),
+    html.Div(id='feedback', style={'marginTop': 10, 'whiteSpace': 'pre-wrap'}),
     html.Div(
         id='error',
         style={'color': 'red', 'marginTop': 10, 'padding': 10, 'border': '1px solid #ffcccc', 'borderRadius': 5}
     ),
     html.Button('Retry', id='retry', n_clicks=0, className='btn btn-secondary',
                 style={'display': 'none', 'marginTop': 10}),
+    *([WebSocket(id='ws', url=WEBSOCKET_URL)] if USE_WEBSOCKET else []),
 ], style={'maxWidth': '800px', 'margin': 'auto', 'padding': 20})
 
 
-@app.callback(
-    [
-        Output('output-chart', 'figure'),
-        Output('error', 'children'),
-        Output('feedback', 'children'),
-        Output('retry', 'style')
-    ],
-    [
-        Input('submit', 'n_clicks'),
-        Input('retry', 'n_clicks')
-    ],
-    [
-        State('prompt', 'value'),
-        State('model-dropdown', 'value') if AI_PROVIDER in ["openai", "azure"] else State('prompt', 'value')
-    ],
-    prevent_initial_call=True
-)
-def generate_chart(submit_clicks, retry_clicks, prompt, selected_model=None):
+async def generate_chart(submit_clicks, retry_clicks, prompt, selected_model=None):
     ctx = dash.callback_context
 
     if not ctx.triggered:
         raise exceptions.PreventUpdate
 
     # Clear previous chart and error
-    fig = {}
+    fig = None
     error_msg = ""
     feedback = ""
 
@@ -138,131 +967,133 @@ def generate_chart(submit_clicks, retry_clicks, prompt, selected_model=None):
     retry_style = {'display': 'none'}
 
     try:
-        # Prepare API call based on provider
-        if AI_PROVIDER == "azure":
-            response = client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": SYSTEM_MESSAGE_CONTENT
-                    },
-                    {
-                        "role": "user",
-                        "content": (
-                            f"Generate only the Plotly Express Python code for: {prompt}. "
-                            "No explanations or text, just the code."
-                        )
-                    }
-                ],
-                model=os.getenv("DEPLOYMENT_NAME"),
-                max_tokens=500,
-                temperature=0.2,
-                top_p=0.1
-            )
-
-        elif AI_PROVIDER == "groq":
-            response = client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": SYSTEM_MESSAGE_CONTENT
-                    },
-                    {
-                        "role": "user",
-                        "content": (
-                            f"Generate only the Plotly Express Python code for: {prompt}. "
-                            "No explanations or text, just the code."
-                        )
-                    }
-                ],
-                model="meta-llama/llama-4-scout-17b-16e-instruct",
-                max_tokens=4096,
-                temperature=0.05,
-                top_p=0.05,
-                timeout=30
-            )
-
-        else:  # OpenAI
-            response = client.chat.completions.create(
-                model=selected_model if selected_model else "gpt-4o",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": SYSTEM_MESSAGE_CONTENT
-                    },
-                    {
-                        "role": "user",
-                        "content": (
-                            f"Generate only the Plotly Express Python code for: {prompt}. "
-                            "No explanations or text, just the code."
-                        )
-                    }
-                ],
-                max_tokens=500,
-                temperature=0.2,
-                top_p=0.1
-            )
-
-        # Extract and clean the generated code (common for all providers)
-        code = response.choices[0].message.content.strip()
-        code = re.sub(r"```(?:python)?|```", "", code).strip()
-
-        # Remove specific unwanted lines or text
-        unwanted_lines = [
-            "YF.download() has changed argument auto_adjust default to True",
-            "[*********************100%***********************]  1 of 1 completed"
-        ]
-        for unwanted in unwanted_lines:
-            code = code.replace(unwanted, "")
-
-        # Filter out lines that start with unwanted keywords
-        unwanted_starts = ['here is', 'below is', 'the code', 'this code', 'note:']
-        code_lines = [
-            line for line in code.split('\n')
-            if not any(line.lower().startswith(start.lower()) for start in unwanted_starts)
-               and line.strip()
-        ]
-        code = '\n'.join(code_lines)
-
-        # print(code)  # DEBUG
-
-        # Ensure there's still some code left
-        if not code:
-            raise ValueError("No valid code remaining after filtering.")
-
-        # Execute the code
-        local_vars = {'px': px, 'pd': pd, 'pdr': pdr, 'datetime': datetime}
-        exec(code, {}, local_vars)
-
-        if 'fig' not in local_vars or local_vars['fig'] is None:
-            raise ValueError("Failed to generate a valid Plotly figure. The figure object is None.")
+        fig_json = await _generate_figure(prompt, selected_model)
 
         # Return the new figure (error/feedback cleared)
-        return local_vars['fig'], "", "", {'display': 'none'}
+        return fig_json, "", "", {'display': 'none'}
 
     except Exception as e:
-        error_msg = "Error: An issue occurred while generating the chart. "
-
-        if "API" in str(e) or any(provider in str(e).lower() for provider in ["azure", "groq", "openai"]):
-            error_msg += "Please check your API key or network connection."
-        elif "invalid syntax" in str(e) or "NameError" in str(e):
-            error_msg += "The AI generated invalid code. Please refine your prompt and try again."
-        elif "unexpected text" in str(e):
-            error_msg += "The AI included extra text instead of just code. Please try again or adjust the prompt."
-        elif "No valid code" in str(e) or "Failed to generate a valid Plotly figure" in str(e):
-            error_msg += (
-                "The chart could not be created. Check if the data or prompt is valid, "
-                "or try a different chart type."
-            )
-        else:
-            error_msg += (
-                f"Unexpected error: {str(e)}. "
-                "Please try a different prompt or contact support."
-            )
-
+        error_msg = _error_message(e)
         print(e)
-        return {}, error_msg, "", {'display': 'block'}
+        return None, error_msg, "", {'display': 'block'}
+
+
+if USE_WEBSOCKET and not WEBSOCKET_URL:
+    # Point the socket at /llm on whatever host and scheme the page was loaded from
+    app.clientside_callback(
+        """
+        function(_) {
+            const scheme = window.location.protocol === "https:" ? "wss:" : "ws:";
+            return scheme + "//" + window.location.host + "/llm";
+        }
+        """,
+        Output('ws', 'url'),
+        Input('ws', 'id')
+    )
+
+if USE_WEBSOCKET:
+    # Send the prompt over the socket from the browser; no server callback round-trip
+    app.clientside_callback(
+        """
+        function(submitClicks, retryClicks, prompt, model) {
+            const noUpdate = window.dash_clientside.no_update;
+            if (!prompt || !prompt.trim()) {
+                return [noUpdate, "Error: Please enter a prompt.", "", {display: "none"}];
+            }
+            const request = JSON.stringify({prompt: prompt, model: model});
+            return [request, "", "Generating chart... This may take a moment.", {display: "none"}];
+        }
+        """,
+        [
+            Output('ws', 'send'),
+            Output('error', 'children'),
+            Output('feedback', 'children'),
+            Output('retry', 'style')
+        ],
+        [
+            Input('submit', 'n_clicks'),
+            Input('retry', 'n_clicks')
+        ],
+        [
+            State('prompt', 'value'),
+            State('model-dropdown', 'value')
+        ],
+        prevent_initial_call=True
+    )
+
+    # Show streamed code as it arrives, then hand the figure to the store
+    app.clientside_callback(
+        """
+        function(message) {
+            const noUpdate = window.dash_clientside.no_update;
+            const msg = JSON.parse(message.data);
+            if (msg.type === "partial") {
+                return [noUpdate, "", "Generating chart...\n\n" + msg.code, noUpdate];
+            }
+            if (msg.type === "fig") {
+                return [msg.figure, "", "", {display: "none"}];
+            }
+            return [null, msg.message, "", {display: "block"}];
+        }
+        """,
+        [
+            Output('fig-store', 'data'),
+            Output('error', 'children', allow_duplicate=True),
+            Output('feedback', 'children', allow_duplicate=True),
+            Output('retry', 'style', allow_duplicate=True)
+        ],
+        Input('ws', 'message'),
+        prevent_initial_call=True
+    )
+else:
+    app.callback(
+        [
+            Output('fig-store', 'data'),
+            Output('error', 'children'),
+            Output('feedback', 'children'),
+            Output('retry', 'style')
+        ],
+        [
+            Input('submit', 'n_clicks'),
+            Input('retry', 'n_clicks')
+        ],
+        [
+            State('prompt', 'value'),
+            State('model-dropdown', 'value') if AI_PROVIDER in ["openai", "azure"] else State('prompt', 'value')
+        ],
+        prevent_initial_call=True
+    )(generate_chart)
+
+
+# Parse the stored figure in the browser, so the server never rebuilds or re-encodes it
+app.clientside_callback(
+    """
+    function(figJson) {
+        return figJson ? JSON.parse(figJson) : {};
+    }
+    """,
+    Output('output-chart', 'figure'),
+    Input('fig-store', 'data')
+)
+
+
+# Production entry points: the Flask server, and an ASGI wrapper for uvicorn, e.g.
+#   uvicorn ai_chart_builder:asgi_app --workers 4
+# Flask requests run on a thread pool, so a chart waiting on the LLM doesn't hold up page
+# loads and assets (asgiref's WsgiToAsgi would serialize them all onto one thread).
+WSGI_THREADS = 16
+
+server = app.server
+asgi_app = WSGIMiddleware(server, workers=WSGI_THREADS)
+
+if USE_WEBSOCKET:
+    asgi_app = Starlette(routes=[
+        WebSocketRoute("/llm", _llm_websocket),
+        Mount("/", app=asgi_app)
+    ])
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Chart workers are spawned and re-import the launch script as __mp_main__; running this
+    # file directly would rebuild the whole app (Dash, HTTP client, LLM loop) in every worker
+    raise SystemExit("Start the app with: python run.py")
@@ -0,0 +1,124 @@
+"""
+Chart Worker
+Executes AI-generated Plotly code inside pool worker processes, so a slow or crashing
+chart cannot block the Dash server or leak figures and DataFrames into it.
+
+Only the figure's JSON crosses the process boundary.
+"""
+import datetime
+import functools
+import hashlib
+import os
+import time
+from pathlib import Path
+
+# Market data fetched by generated code is kept as parquet, so the second chart of the
+# same symbol and date range reads from disk instead of waiting on a remote API.
+DATA_CACHE_DIR = Path(".yf_cache")
+DATA_CACHE_TTL = 86400  # seconds
+
+
+def preimport():
+    """Pool initializer: pay the heavy imports once per worker instead of once per chart."""
+    import pandas  # noqa: F401
+    import plotly.express  # noqa: F401
+    import plotly.io
+
+    # fig.to_json() dominates execution time for long time series; orjson is several times faster
+    plotly.io.json.config.default_engine = "orjson"
+
+    _install_data_cache()
+
+
+def _cache_arg(value):
+    # Generated code usually passes datetime.now()-based bounds; key on the day so they repeat
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def _cached_fetch(fetch):
+    """Wrap a DataFrame-returning fetch function with a parquet cache on disk."""
+    import pandas as pd
+
+    @functools.wraps(fetch)
+    def wrapper(*args, **kwargs):
+        raw = repr((
+            fetch.__module__,
+            fetch.__qualname__,
+            [_cache_arg(arg) for arg in args],
+            sorted((name, _cache_arg(value)) for name, value in kwargs.items())
+        ))
+        path = DATA_CACHE_DIR / f"{hashlib.md5(raw.encode()).hexdigest()}.parquet"
+        if path.exists() and time.time() - path.stat().st_mtime < DATA_CACHE_TTL:
+            return pd.read_parquet(path)
+
+        data = fetch(*args, **kwargs)
+        if isinstance(data, pd.DataFrame) and not data.empty:
+            try:
+                DATA_CACHE_DIR.mkdir(exist_ok=True)
+                # Write then rename, so other workers never read a half-written file
+                tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+                data.to_parquet(tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                print(e)
+        return data
+
+    return wrapper
+
+
+def _install_data_cache():
+    """Route yfinance downloads in this worker through the parquet cache.
+
+    Generated code imports yfinance itself, so the module function is patched rather
+    than injecting a wrapper into its namespace. Patching is per worker process.
+    """
+    try:
+        import yfinance
+    except ImportError:
+        return
+    yfinance.download = _cached_fetch(yfinance.download)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_pdr():
+    """Import pandas_datareader (with its DataReader cached) only for charts that use it.
+
+    It is slow to import and rarely needed, so workers do not pay for it up front.
+    """
+    import pandas_datareader
+    import pandas_datareader.data
+
+    cached_reader = _cached_fetch(pandas_datareader.data.DataReader)
+    pandas_datareader.DataReader = cached_reader
+    pandas_datareader.data.DataReader = cached_reader
+    return pandas_datareader
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_code(code):
+    """Compile generated code once; cached and repeated replies skip the parse step."""
+    return compile(code, "<llm>", "exec")
+
+
+def run_code(code):
+    """Execute generated chart code and return the resulting figure as a JSON string."""
+    import pandas as pd
+    import plotly.express as px
+
+    local_vars = {'px': px, 'pd': pd, 'datetime': datetime}
+    if 'pdr' in code or 'pandas_datareader' in code:
+        # Also makes the code's own pandas_datareader import pick up the cached DataReader
+        local_vars['pdr'] = _get_pdr()
+    exec(_compile_code(code), {}, local_vars)
+
+    if 'fig' not in local_vars or local_vars['fig'] is None:
+        raise ValueError("Failed to generate a valid Plotly figure. The figure object is None.")
+
+    # Keep zoom and legend state when the same chart is re-rendered; reset it for a new one
+    fig = local_vars['fig']
+    fig.update_layout(uirevision=hashlib.md5(code.encode()).hexdigest())
+    return fig.to_json()
@@ -0,0 +1,9 @@
+"""
+AI Chart Builder launcher (development server).
+Chart workers are spawned processes that re-import whatever script started the app. Keeping
+the import under the __main__ guard means they only load chart_worker, not a second Dash app.
+"""
+if __name__ == '__main__':
+    from ai_chart_builder import app
+
+    app.run(debug=True)